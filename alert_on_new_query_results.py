@@ -1,21 +1,66 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import json
 import logging
 import logging.config
+import logging.handlers
 import os
+import queue
+import time
+from typing import Dict
 
 import expertvoice_client
+from batching_queue_listener import BatchingQueueListener
+from price_history import PriceHistory
+from product_index import ProductIndex
 
 APP_NAME = "expertvoice_alert_on_new_query_results"
 
+# saved query keys that are evaluated locally, rather than passed to the search
+PRICE_CONDITION_KEYS = {
+    "min_price_drop_percent",
+    "price_drop_window_days",
+    "min_discount_percent",
+}
+
 # TODO overhaul seen listings method
 # instead of being date based, we should instead just pull product IDs
 # if it's in seen listings, don't alert on it (but track it)
 # at end of execution, write all results (ignoring seen listings) to seen_listings file
 
 
+def meets_price_conditions(
+    listing: Dict, price_conditions: Dict, price_history: PriceHistory
+) -> bool:
+    price = float(listing["price"])
+
+    min_discount_percent = price_conditions.get("min_discount_percent")
+    if min_discount_percent is not None:
+        if not listing["msrp"]:
+            return False
+        msrp = float(listing["msrp"])
+        if (msrp - price) / msrp * 100 < min_discount_percent:
+            return False
+
+    min_price_drop_percent = price_conditions.get("min_price_drop_percent")
+    if min_price_drop_percent is not None:
+        since = None
+        if price_conditions.get("price_drop_window_days") is not None:
+            since = int(
+                time.time() - price_conditions["price_drop_window_days"] * 86400
+            )
+
+        max_price = price_history.get_max_price(listing["productCode"], since=since)
+        if not max_price or (max_price - price) / max_price * 100 < (
+            min_price_drop_percent
+        ):
+            return False
+
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser()
     query_group = parser.add_mutually_exclusive_group(required=True)
@@ -39,6 +84,12 @@ def main():
         action="store_true",
         help="If set, log URLs in markdown format (for gotify)",
     )
+    parser.add_argument(
+        "--index-path",
+        type=str,
+        help="If set, evaluate queries against the local product index "
+        "at the provided path (see get_products_csv.py) instead of the live search",
+    )
     parser.add_argument(
         "--config",
         type=str,
@@ -60,6 +111,34 @@ def main():
         print("Saved queries: %s" % (", ".join(sorted(config["saved_queries"].keys()))))
         return
 
+    # deliver alerts from a background thread, in batches,
+    # so that slow handlers (eg. gotify) don't hold up query execution.
+    # this covers handlers on ancestor loggers (eg. root) that records
+    # would otherwise propagate to and be delivered on this thread
+    alert_handlers = list()
+    current_logger = logger
+    while current_logger is not None:
+        alert_handlers.extend(current_logger.handlers)
+        if not current_logger.propagate:
+            break
+        current_logger = current_logger.parent
+
+    if alert_handlers:
+        alert_delivery_config = config.get("alert_delivery", dict())
+        delivery_queue = queue.Queue()
+        listener = BatchingQueueListener(
+            delivery_queue,
+            alert_handlers,
+            max_batch_size=alert_delivery_config.get("max_batch_size", 10),
+            flush_interval=alert_delivery_config.get("flush_interval", 5.0),
+        )
+        logger.handlers = [logging.handlers.QueueHandler(delivery_queue)]
+        logger.propagate = False
+        listener.start()
+
+        # flush pending alerts even if we exit early
+        atexit.register(listener.stop)
+
     # init seen listings
     seen_listings_filename = config.get("seen_listings_filename", "seen_listings.json")
     if os.path.isfile(seen_listings_filename):
@@ -73,23 +152,53 @@ def main():
     else:
         queries_to_run = {args.query_name: config["saved_queries"][args.query_name]}
 
-    ev = expertvoice_client.ExpertvoiceClient(config)
     new_seen_listings = dict()
+    price_history = PriceHistory(
+        config.get("price_history_filename", "price_history.sqlite3")
+    )
+
+    # the local index doesn't need an authenticated session
+    if args.index_path:
+        searcher = ProductIndex.load(args.index_path)
+    else:
+        searcher = expertvoice_client.ExpertvoiceClient(
+            config, price_history=price_history
+        )
 
     for query_name, query_json in queries_to_run.items():
-        query_res = ev.search_products(**query_json)
+        price_conditions = {
+            k: v for k, v in query_json.items() if k in PRICE_CONDITION_KEYS
+        }
+        query_res = searcher.search_products(
+            **{k: v for k, v in query_json.items() if k not in PRICE_CONDITION_KEYS}
+        )
 
         alert_queue = list()
 
         for listing in query_res:
             item_id = str(listing["productCode"])
-            new_seen_listings[item_id] = ""
 
-            # skip seen listings
-            if item_id in seen_listings:
+            # listings are only tracked as seen once they've met the price conditions,
+            # so that listings meeting them later on are still alerted on
+            if price_conditions and not meets_price_conditions(
+                listing, price_conditions, price_history
+            ):
                 continue
 
-            listing["url"] = ev.get_product_url(
+            new_seen_listings[item_id] = listing["price"]
+
+            # skip seen listings,
+            # unless they've gotten cheaper while meeting the price conditions
+            if item_id in seen_listings:
+                seen_price = seen_listings[item_id]
+                if not (
+                    price_conditions
+                    and seen_price not in ("", None)
+                    and float(listing["price"]) < float(seen_price)
+                ):
+                    continue
+
+            listing["url"] = expertvoice_client.ExpertvoiceClient.get_product_url(
                 listing["orgId"], listing["productCode"]
             )
             alert_queue.append(listing)
@@ -137,6 +246,8 @@ def main():
     with open(seen_listings_filename, "w") as f:
         json.dump(new_seen_listings, f)
 
+    price_history.close()
+
 
 if __name__ == "__main__":
     main()
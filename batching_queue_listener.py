@@ -0,0 +1,87 @@
+import logging
+import queue
+import threading
+import time
+from typing import List, Optional
+
+
+class BatchingQueueListener:
+    """
+    Like `logging.handlers.QueueListener`, but delivers records in batches.
+
+    Records are pulled off the queue on a background thread and held until
+    `max_batch_size` records have accumulated, or `flush_interval` seconds have
+    passed since the oldest record in the batch arrived. Each batch is then
+    coalesced into a single record per logger and level, whose message is the
+    batched messages joined by blank lines, and passed to `handlers`.
+    """
+
+    _sentinel = None
+
+    def __init__(
+        self,
+        queue: queue.Queue,
+        handlers: List[logging.Handler],
+        max_batch_size: int = 10,
+        flush_interval: float = 5.0,
+    ):
+        self.queue = queue
+        self.handlers = handlers
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Deliver any pending records and stop the background thread.
+        Safe to call more than once
+        """
+        if self._thread is None:
+            return
+
+        self.queue.put_nowait(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def _monitor(self):
+        batch = list()
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0, deadline - time.monotonic())
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush(batch)
+                batch = list()
+                continue
+
+            if record is self._sentinel:
+                self._flush(batch)
+                break
+
+            if not batch:
+                deadline = time.monotonic() + self.flush_interval
+            batch.append(record)
+
+            if len(batch) >= self.max_batch_size:
+                self._flush(batch)
+                batch = list()
+
+    def _flush(self, batch: List[logging.LogRecord]):
+        # group by logger and level, so handler levels still apply as configured
+        groups = dict()
+        for record in batch:
+            groups.setdefault((record.name, record.levelno), list()).append(record)
+
+        for records in groups.values():
+            coalesced = logging.makeLogRecord(records[0].__dict__)
+            coalesced.msg = "\n\n".join(record.getMessage() for record in records)
+            coalesced.args = None
+
+            for handler in self.handlers:
+                if coalesced.levelno >= handler.level:
+                    handler.handle(coalesced)
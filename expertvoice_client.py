@@ -1,8 +1,16 @@
 import urllib.parse
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 import requests
-from requests.exceptions import JSONDecodeError
+from requests.exceptions import HTTPError, JSONDecodeError
+
+from price_history import PriceHistory
+
+
+class APIError(Exception):
+    """
+    Raised when ExpertVoice responds successfully, but with an error in the body
+    """
 
 
 def flatten_taxonomy(
@@ -30,6 +38,69 @@ def flatten_taxonomy(
     return result
 
 
+def get_search_filters(
+    genders: Optional[List[str]] = None,
+    brands: Optional[List[int]] = None,
+    category_id: Optional[int] = None,
+    promotion_extra_savings: bool = False,
+    promotion_free_shipping: bool = False,
+    promotion_friends_and_family: bool = False,
+    promotion_outlet: bool = False,
+    promotion_flash_deal: bool = False,
+    hide_out_of_stock: bool = False,
+) -> Dict:
+    filters = {"TRAIT_PER_DEAL": []}
+
+    # set filters
+    if hide_out_of_stock:
+        filters["IN_STOCK_DEAL"] = ["true"]
+    if category_id:
+        filters["TAXONOMY"] = [category_id]
+    if genders:
+        # TODO check all values againt ExpertvoiceClient.GENDERS
+        # TODO do these need to be ordered in any specific way?
+        filters["TRAIT.3"] = genders
+
+    if brands:
+        filters["ORGANIZATION"] = brands
+
+    if promotion_extra_savings:
+        filters["TRAIT_PER_DEAL"].append(
+            ExpertvoiceClient.PROMOTION_LOOKUP["extra_savings"]
+        )
+
+    if promotion_free_shipping:
+        filters["TRAIT_PER_DEAL"].append(
+            ExpertvoiceClient.PROMOTION_LOOKUP["free_shipping"]
+        )
+
+    if promotion_outlet:
+        filters["TRAIT_PER_DEAL"].append(ExpertvoiceClient.PROMOTION_LOOKUP["outlet"])
+
+    if promotion_flash_deal:
+        filters["TRAIT_PER_DEAL"].append(
+            ExpertvoiceClient.PROMOTION_LOOKUP["flash_deal"]
+        )
+
+    if promotion_friends_and_family:
+        filters["TRAIT_PER_DEAL"].append(
+            ExpertvoiceClient.PROMOTION_LOOKUP["friends_and_family"]
+        )
+
+    return filters
+
+
+def parse_result_item(item: Dict) -> Dict:
+    return {
+        "brand": item["owner"]["name"],
+        "name": item["text"],
+        "price": item["metadata"]["price"],
+        "msrp": item["metadata"]["retailPrice"],
+        "orgId": item["metadata"]["orgId"],
+        "productCode": item["metadata"]["productCode"],
+    }
+
+
 class ExpertvoiceClient:
     LOGIN_LANDING_PAGE = "https://www.expertvoice.com/sign-in"
     LOGIN_URL = "https://www.expertvoice.com/sign-on/service/sign-in"
@@ -45,7 +116,21 @@ class ExpertvoiceClient:
         "friends_and_family": 9,
     }
 
-    def __init__(self, config: Dict):
+    # page sizes to try for paginated endpoints, largest first.
+    # DEFAULT_PAGE_SIZE is what the browser UI uses, so it's always accepted
+    DEFAULT_PAGE_SIZE = 36
+    PAGE_SIZE_CANDIDATES = (500, 250, 100, DEFAULT_PAGE_SIZE)
+
+    # ExpertVoice responds with an HTTP 500 past this many results
+    MAX_RESULTS = 10000
+
+    def __init__(self, config: Dict, price_history: Optional[PriceHistory] = None):
+        # if set, every product fetched is recorded in the price history
+        self.price_history = price_history
+
+        # largest page size each paginated endpoint has accepted, by endpoint name
+        self.page_sizes: Dict[str, int] = dict()
+
         self.expertvoice_session = requests.Session()
         self.expertvoice_session.hooks[
             "response"
@@ -68,7 +153,8 @@ class ExpertvoiceClient:
 
         self.categories = self.get_categories()
 
-    def get_product_url(self, org_id, product_code) -> str:
+    @staticmethod
+    def get_product_url(org_id, product_code) -> str:
         return (
             f"https://www.expertvoice.com/product/bottom_text/{org_id}?p="
             + urllib.parse.quote(product_code)
@@ -105,37 +191,17 @@ class ExpertvoiceClient:
         hide_out_of_stock: bool = False,
     ) -> List[Dict]:
         # TODO expand search option filters
-
-        configuration_override_filters = {"TRAIT_PER_DEAL": []}
-
-        # set filters
-        if hide_out_of_stock:
-            configuration_override_filters["IN_STOCK_DEAL"] = ["true"]
-        if category_id:
-            configuration_override_filters["TAXONOMY"] = [category_id]
-        if genders:
-            # TODO check all values againt ExpertvoiceClient.GENDERS
-            # TODO do these need to be ordered in any specific way?
-            configuration_override_filters["TRAIT.3"] = genders
-
-        if brands:
-            configuration_override_filters["ORGANIZATION"] = brands
-
-        # TODO source PROMOTION_LOOKUP
-        if promotion_extra_savings:
-            configuration_override_filters["TRAIT_PER_DEAL"].append(5)
-
-        if promotion_free_shipping:
-            configuration_override_filters["TRAIT_PER_DEAL"].append(6)
-
-        if promotion_outlet:
-            configuration_override_filters["TRAIT_PER_DEAL"].append(7)
-
-        if promotion_flash_deal:
-            configuration_override_filters["TRAIT_PER_DEAL"].append(8)
-
-        if promotion_friends_and_family:
-            configuration_override_filters["TRAIT_PER_DEAL"].append(9)
+        configuration_override_filters = get_search_filters(
+            genders=genders,
+            brands=brands,
+            category_id=category_id,
+            promotion_extra_savings=promotion_extra_savings,
+            promotion_free_shipping=promotion_free_shipping,
+            promotion_friends_and_family=promotion_friends_and_family,
+            promotion_outlet=promotion_outlet,
+            promotion_flash_deal=promotion_flash_deal,
+            hide_out_of_stock=hide_out_of_stock,
+        )
 
         # gotta love seeing lists of JSON objects
         products_json = {
@@ -164,7 +230,7 @@ class ExpertvoiceClient:
                 {
                     "configurationOverrides": {
                         "filters": configuration_override_filters,
-                        "maxResults": 36,
+                        "maxResults": ExpertvoiceClient.DEFAULT_PAGE_SIZE,
                         "startResults": 0,
                         "options": {"ZCFCTS": True},
                         "providerTimeoutMS": 5000,
@@ -181,46 +247,149 @@ class ExpertvoiceClient:
             },
             "searchTerm": search_term,
         }
-        results = list()
-        total_results = -1  # for kick-off
-        while len(results) < total_results or total_results == -1:
+        # TODO we know the index since we wrote it,
+        # but we should find this configuration by
+        # searching for the dict with `key == "ProductSearchProvider"`
+        provider_configuration = products_json["providerConfigurations"][3][
+            "configurationOverrides"
+        ]
+
+        def fetch_search_page(page_size: int) -> Tuple[int, List[Dict]]:
+            provider_configuration["maxResults"] = page_size
             page_res = self.expertvoice_session.post(
                 f"{ExpertvoiceClient.API_ROOT}/search/ext/2.0/search",
                 json=products_json,
-                # ).json()['providerResults']['ProductSearchProvider']
             ).json()["providerResults"]["ProductSearchProvider"]
-            total_results = page_res[
-                "totalResults"
-            ]  # TODO I don't want to keep setting this...
+
+            return page_res["totalResults"], [
+                parse_result_item(item) for item in page_res["resultItems"]
+            ]
+
+        results = list()
+        total_results = -1  # for kick-off
+        while (
+            provider_configuration["startResults"] < total_results
+            or total_results == -1
+        ):
+            if provider_configuration["startResults"] >= ExpertvoiceClient.MAX_RESULTS:
+                break
+
+            total_results, page_items = self._fetch_page(
+                "search", fetch_search_page, provider_configuration["startResults"]
+            )
+            if not page_items:
+                break
 
             # TODO the last page likes to over-fill the buffer, and repeat
-            for item in page_res["resultItems"]:
-                results.append(
-                    {
-                        "brand": item["owner"]["name"],
-                        "name": item["text"],
-                        "price": item["metadata"]["price"],
-                        "msrp": item["metadata"]["retailPrice"],
-                        "orgId": item["metadata"]["orgId"],
-                        "productCode": item["metadata"]["productCode"],
-                    }
-                )
+            results.extend(page_items)
+            provider_configuration["startResults"] += len(page_items)
 
-            # TODO we know the index since we wrote it,
-            # but we should find this configuration by
-            # searching for the dict with `key == "ProductSearchProvider"`
-            products_json["providerConfigurations"][3]["configurationOverrides"][
-                "startResults"
-            ] += len(page_res["resultItems"])
+        if self.price_history is not None:
+            self.price_history.record(results)
 
         return results
 
-    def get_products(self, category_id: int) -> List[Dict]:
+    def _fetch_page(
+        self,
+        endpoint: str,
+        fetch: Callable[[int], Tuple[int, List[Dict]]],
+        start_results: int,
+        max_results: Optional[int] = None,
+    ) -> Tuple[int, List[Dict]]:
+        """
+        Fetch a page of results via `fetch`, which takes the page size to request.
+
+        Unless `max_results` is given, the largest page size accepted by
+        `endpoint` is used, starting from the largest candidate.
+        A rejected request is retried once, then the page size is stepped down,
+        until `DEFAULT_PAGE_SIZE` is also rejected. The page size is also lowered
+        to match (but not below `DEFAULT_PAGE_SIZE`) if the server returns
+        fewer results than requested
+        """
+        max_page_size = ExpertvoiceClient.MAX_RESULTS - start_results
+        if max_results is not None:
+            return fetch(min(max_results, max_page_size))
+
+        page_size = self.page_sizes.get(
+            endpoint, ExpertvoiceClient.PAGE_SIZE_CANDIDATES[0]
+        )
+        retried = False
+        while True:
+            requested_page_size = min(page_size, max_page_size)
+            try:
+                total_results, page_items = fetch(requested_page_size)
+            except (HTTPError, APIError) as e:
+                # auth failures aren't down to the page size
+                if (
+                    isinstance(e, HTTPError)
+                    and e.response is not None
+                    and e.response.status_code in (401, 403)
+                ):
+                    raise
+
+                # give transient errors a second chance before stepping down
+                if not retried:
+                    retried = True
+                    continue
+
+                smaller_page_sizes = [
+                    candidate
+                    for candidate in ExpertvoiceClient.PAGE_SIZE_CANDIDATES
+                    if candidate < page_size
+                ]
+                if not smaller_page_sizes:
+                    raise
+
+                page_size = smaller_page_sizes[0]
+                retried = False
+                continue
+
+            # a short page that isn't the last page means the server truncated it.
+            # never go below the UI's page size, which is always accepted
+            if (
+                page_items
+                and len(page_items) < requested_page_size
+                and start_results + len(page_items) < total_results
+            ):
+                page_size = max(len(page_items), ExpertvoiceClient.DEFAULT_PAGE_SIZE)
+
+            self.page_sizes[endpoint] = page_size
+            return total_results, page_items
+
+    def get_products_page(
+        self,
+        category_id: int,
+        start_results: int = 0,
+        filters: Optional[Dict] = None,
+        max_results: Optional[int] = None,
+        sort_field: str = "RECOMMENDED",
+    ) -> Tuple[int, List[Dict]]:
+        """
+        Fetch a single page of products for a category.
+        `filters` may contain any additional store search filters,
+        eg. {"TRAIT.3": ["Men's"]} - see `get_search_filters`.
+        If `max_results` isn't set, the largest accepted page size is used.
+        Products are sorted by `sort_field`, descending - "id" gives newest first
+
+        Returns a tuple of the category's `totalResults` and the page's products
+        """
+
+        def fetch_products_page(page_size: int) -> Tuple[int, List[Dict]]:
+            products_json["searchConfiguration"]["maxResults"] = page_size
+            page_res = self.expertvoice_session.post(
+                f"{ExpertvoiceClient.API_ROOT}/store-services/ext/v1/stores/search/products",
+                json=products_json,
+            ).json()
+
+            return page_res["totalResults"], [
+                parse_result_item(item) for item in page_res["resultItems"]
+            ]
+
         products_json = {
             "searchTerm": None,
             "searchConfiguration": {
-                "filters": {"TAXONOMY": [category_id]},
-                "maxResults": 36,
+                "filters": {**(filters or dict()), "TAXONOMY": [category_id]},
+                "maxResults": ExpertvoiceClient.DEFAULT_PAGE_SIZE,
                 "options": {
                     "ALGV": None,
                     "CNTXT": "TAXONOMY",
@@ -228,34 +397,52 @@ class ExpertvoiceClient:
                     "ZCFCTS": True,
                 },
                 "sortDirection": "DESC",
-                "sortField": "RECOMMENDED",
-                "startResults": 0,
+                "sortField": sort_field,
+                "startResults": start_results,
             },
         }
 
+        return self._fetch_page(
+            "products", fetch_products_page, start_results, max_results=max_results
+        )
+
+    def get_products(
+        self,
+        category_id: int,
+        filters: Optional[Dict] = None,
+        first_page: Optional[Tuple[int, List[Dict]]] = None,
+        sort_field: str = "RECOMMENDED",
+    ) -> List[Dict]:
+        """
+        Fetch every product in a category.
+        If the first page has already been fetched via `get_products_page`,
+        it may be passed as `first_page` to save a request -
+        it must have been fetched with the same `sort_field`
+        """
         results = list()
         total_results = -1  # for kick-off
-        while len(results) < total_results or total_results == -1:
-            page_res = self.expertvoice_session.post(
-                "https://www.expertvoice.com/xapi/store-services/ext/v1/stores/search/products",
-                json=products_json,
-            ).json()
-            total_results = page_res[
-                "totalResults"
-            ]  # TODO I don't want to keep setting this...
-            for item in page_res["resultItems"]:
-                results.append(
-                    {
-                        "brand": item["owner"]["name"],
-                        "name": item["text"],
-                        "price": item["metadata"]["price"],
-                        "msrp": item["metadata"]["retailPrice"],
-                    }
-                )
+        if first_page is not None:
+            total_results, page_items = first_page
+            results.extend(page_items)
 
-            products_json["searchConfiguration"]["startResults"] += len(
-                page_res["resultItems"]
+        while len(results) < total_results or total_results == -1:
+            if len(results) >= ExpertvoiceClient.MAX_RESULTS:
+                break
+
+            total_results, page_items = self.get_products_page(
+                category_id,
+                start_results=len(results),
+                filters=filters,
+                sort_field=sort_field,
             )
+            if not page_items:
+                break
+
+            results.extend(page_items)
+
+        # filtered crawls only ever return a subset of an unfiltered one
+        if self.price_history is not None and not filters:
+            self.price_history.record(results)
 
         return results
 
@@ -269,4 +456,4 @@ def err_hook(res):
         return
 
     if js.get("err", None):
-        raise BaseException(f"API Exception - {js.get('errorMessage', '')}")
+        raise APIError(f"API Exception - {js.get('errorMessage', '')}")
@@ -2,9 +2,31 @@
 
 import argparse
 import csv
+import hashlib
 import json
+import os
+from typing import Dict, List, Optional, Tuple
 
 from expertvoice_client import ExpertvoiceClient
+from price_history import PriceHistory
+from product_index import ProductIndex, crawl_trait_postings, get_category_ancestors
+
+# a stable, newest-first ordering for category fingerprints
+FINGERPRINT_SORT_FIELD = "id"
+
+
+def get_category_fingerprint(total_results: int, first_page: List[Dict]) -> str:
+    """
+    A cheap fingerprint of a category's contents,
+    from its total result count and the products on its first page
+    """
+    first_page_hash = hashlib.sha1(
+        json.dumps(
+            [[product["productCode"], product["price"]] for product in first_page]
+        ).encode()
+    ).hexdigest()
+
+    return f"{total_results}:{first_page_hash}"
 
 
 def main():
@@ -34,39 +56,146 @@ def main():
         help="If specified, any number of category IDs. "
         "Else, all categories will be downloaded",
     )
+    parser.add_argument(
+        "--index-path",
+        type=str,
+        help="If set, build a local product index from the crawl "
+        "and save it to the provided path",
+    )
+    parser.add_argument(
+        "--snapshot-path",
+        type=str,
+        help="If set, the path to a snapshot of the previous crawl. "
+        "Categories that haven't changed since will be served from the snapshot, "
+        "and the snapshot will be updated after crawling",
+    )
     args = parser.parse_args()
 
     with open(args.config, "r") as f:
         config = json.load(f)
 
-    ev = ExpertvoiceClient(config)
-    all_products = dict()
+    price_history = PriceHistory(
+        config.get("price_history_filename", "price_history.sqlite3")
+    )
+    ev = ExpertvoiceClient(config, price_history=price_history)
 
     categories = ev.get_categories(
         depth=6, short_category_name=args.short_category_names
     )
+    category_ancestors = get_category_ancestors(categories)
     product_rows = list()
+    index = ProductIndex() if args.index_path else None
+
+    snapshot = dict()
+    if args.snapshot_path and os.path.isfile(args.snapshot_path):
+        with open(args.snapshot_path, "r") as f:
+            snapshot = json.load(f)
+
+    def crawl_category(category_dict: Dict) -> Tuple[List[Dict], Optional[Dict]]:
+        """
+        Crawl a category's products and, when building an index,
+        its trait postings (see `crawl_trait_postings`)
+        """
+        category_id = category_dict["id"]
+        if not args.snapshot_path:
+            products = ev.get_products(category_id)
+            trait_postings = None
+            if index is not None:
+                trait_postings = crawl_trait_postings(
+                    ev,
+                    category_dict,
+                    [str(product["productCode"]) for product in products],
+                )
+
+            return products, trait_postings
+
+        # fetch the first page of the category to check whether it's changed.
+        # the page size is pinned so fingerprints are comparable between runs,
+        # and newest products come first so that new arrivals change the hash
+        first_page = ev.get_products_page(
+            category_id,
+            max_results=ExpertvoiceClient.DEFAULT_PAGE_SIZE,
+            sort_field=FINGERPRINT_SORT_FIELD,
+        )
+        fingerprint = get_category_fingerprint(*first_page)
+        category_snapshot = snapshot.get(str(category_id), dict())
+        if category_snapshot.get("fingerprint") != fingerprint:
+            category_snapshot = {
+                "fingerprint": fingerprint,
+                "products": ev.get_products(
+                    category_id,
+                    first_page=first_page,
+                    sort_field=FINGERPRINT_SORT_FIELD,
+                ),
+            }
+            snapshot[str(category_id)] = category_snapshot
+
+        # trait postings are kept in the snapshot too, as they're the bulk of
+        # an index crawl's requests. older snapshots may not have them yet
+        if index is not None and "trait_postings" not in category_snapshot:
+            category_snapshot["trait_postings"] = crawl_trait_postings(
+                ev,
+                category_dict,
+                [
+                    str(product["productCode"])
+                    for product in category_snapshot["products"]
+                ],
+            )
+
+        return category_snapshot["products"], category_snapshot.get("trait_postings")
 
     for category_dict in categories:
-        category_products = list()
         if args.category_ids:
-            if "id" in category_dict and category_dict["id"] in args.category_ids:
-                category_products = ev.get_products(category_id=category_dict["id"])
+            should_crawl = (
+                "id" in category_dict and category_dict["id"] in args.category_ids
+            )
+        else:
+            should_crawl = "taxonomy" not in category_dict
+
+        if not should_crawl:
+            continue
 
-        elif "taxonomy" not in category_dict:
-            all_products[category_dict["name"]] = ev.get_products(category_dict["id"])
-            category_products = ev.get_products(category_dict["id"])
+        category_products, trait_postings = crawl_category(category_dict)
 
         for product in category_products:
-            product.pop("orgId", None)
-            product.pop("productCode", None)
-            product_rows.append({**product, **{"category": category_dict["name"]}})
+            if index is not None:
+                index.add_product(
+                    product, category_ancestors.get(category_dict["id"], [])
+                )
+
+            product_rows.append(
+                {
+                    **{
+                        k: v
+                        for k, v in product.items()
+                        if k not in ("orgId", "productCode")
+                    },
+                    **{"category": category_dict["name"]},
+                }
+            )
+
+        # trait postings are only gathered for the categories we've crawled
+        if index is not None:
+            index.add_trait_postings(trait_postings)
+
+    if args.snapshot_path:
+        # write to a temporary file first, so an interrupted write
+        # can't leave a truncated snapshot behind
+        tmp_snapshot_path = f"{args.snapshot_path}.tmp"
+        with open(tmp_snapshot_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_snapshot_path, args.snapshot_path)
+
+    if index is not None:
+        index.save(args.index_path)
 
     with open(args.out_path, "w", newline="", encoding="utf-8") as f:
         writer = csv.DictWriter(f, fieldnames=product_rows[0].keys())
         writer.writeheader()
         writer.writerows(product_rows)
 
+    price_history.close()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,93 @@
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class PriceHistory:
+    """
+    A time series of product prices, keyed by `productCode`.
+
+    Only price changes are stored - an observation that matches a product's
+    most recent price and MSRP is dropped. Rows are clustered by productCode
+    (`WITHOUT ROWID`), so per-product lookups stay fast as history grows.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS price_history ("
+            "product_code TEXT NOT NULL, "
+            "observed_at INTEGER NOT NULL, "
+            "price REAL, "
+            "msrp REAL, "
+            "PRIMARY KEY (product_code, observed_at)"
+            ") WITHOUT ROWID"
+        )
+        self.conn.commit()
+
+    def get_latest(self, product_code: str) -> Optional[Tuple[int, float, float]]:
+        return self.conn.execute(
+            "SELECT observed_at, price, msrp FROM price_history "
+            "WHERE product_code = ? ORDER BY observed_at DESC LIMIT 1",
+            (str(product_code),),
+        ).fetchone()
+
+    def get_history(self, product_code: str) -> List[Tuple[int, float, float]]:
+        return self.conn.execute(
+            "SELECT observed_at, price, msrp FROM price_history "
+            "WHERE product_code = ? ORDER BY observed_at",
+            (str(product_code),),
+        ).fetchall()
+
+    def get_max_price(
+        self, product_code: str, since: Optional[int] = None
+    ) -> Optional[float]:
+        """
+        Get the highest price recorded for a product,
+        optionally only considering prices observed at or after `since`.
+        Note that a price set before `since` and still in effect is included
+        """
+        if since is None:
+            since = 0
+
+        return self.conn.execute(
+            "SELECT MAX(price) FROM price_history WHERE product_code = ? AND ("
+            "observed_at >= ? OR observed_at = ("
+            "SELECT MAX(observed_at) FROM price_history "
+            "WHERE product_code = ? AND observed_at <= ?))",
+            (str(product_code), since, str(product_code), since),
+        ).fetchone()[0]
+
+    def record(self, products: Iterable[Dict], observed_at: Optional[int] = None):
+        """
+        Record the `price` and `msrp` of each product,
+        if either has changed since the product was last observed
+        """
+        if observed_at is None:
+            observed_at = int(time.time())
+
+        rows = list()
+        for product in products:
+            if product.get("productCode") is None or product.get("price") is None:
+                continue
+
+            product_code = str(product["productCode"])
+            price = float(product["price"])
+            msrp = float(product["msrp"]) if product.get("msrp") is not None else None
+
+            latest = self.get_latest(product_code)
+            if latest is not None and latest[1:] == (price, msrp):
+                continue
+
+            rows.append((product_code, observed_at, price, msrp))
+
+        # a single transaction per batch of products
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO price_history "
+                "(product_code, observed_at, price, msrp) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def close(self):
+        self.conn.close()
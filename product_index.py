@@ -0,0 +1,264 @@
+import json
+import logging
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+from expertvoice_client import ExpertvoiceClient
+
+logger = logging.getLogger(__name__)
+
+TOKEN_REGEX = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> Set[str]:
+    return set(TOKEN_REGEX.findall(text.lower()))
+
+
+class ProductIndex:
+    """
+    A local inverted index over a crawl of the ExpertVoice catalog.
+
+    Postings are kept as sets of `productCode`s, keyed by brand (orgId),
+    category ID (including all ancestor categories), gender trait,
+    promotion trait, stock, and the tokens of each product's brand and name.
+    `search_products` accepts the same arguments as
+    `ExpertvoiceClient.search_products`, and returns results of the same shape.
+    """
+
+    def __init__(self):
+        self.products: Dict[str, Dict] = dict()
+        self.by_org: Dict[str, Set[str]] = defaultdict(set)
+        self.by_category: Dict[str, Set[str]] = defaultdict(set)
+        self.by_gender: Dict[str, Set[str]] = defaultdict(set)
+        self.by_promotion: Dict[str, Set[str]] = defaultdict(set)
+        self.in_stock: Set[str] = set()
+        self.by_token: Dict[str, Set[str]] = defaultdict(set)
+
+    def add_product(self, product: Dict, category_ids: Iterable[int] = ()) -> None:
+        product_code = str(product["productCode"])
+        if product_code not in self.products:
+            self.products[product_code] = product
+            self.by_org[str(product["orgId"])].add(product_code)
+            for token in tokenize(f"{product['brand']} {product['name']}"):
+                self.by_token[token].add(product_code)
+
+        for category_id in category_ids:
+            self.by_category[str(category_id)].add(product_code)
+
+    def add_trait_postings(self, trait_postings: Dict) -> None:
+        """
+        Merge in the gender, promotion and stock postings of a category,
+        as returned by `crawl_trait_postings`
+        """
+
+        # only track products that made it into the index proper
+        def indexed(product_codes: Iterable[str]) -> Set[str]:
+            return set(product_codes) & self.products.keys()
+
+        for gender, product_codes in trait_postings["genders"].items():
+            self.by_gender[gender] |= indexed(product_codes)
+
+        for promotion, product_codes in trait_postings["promotions"].items():
+            self.by_promotion[promotion] |= indexed(product_codes)
+
+        self.in_stock |= indexed(trait_postings["in_stock"])
+
+    def search_products(
+        self,
+        search_term: str = "",
+        genders: Optional[List[str]] = None,
+        brands: Optional[List[int]] = None,
+        category_id: Optional[int] = None,
+        promotion_extra_savings: bool = False,
+        promotion_free_shipping: bool = False,
+        promotion_friends_and_family: bool = False,
+        promotion_outlet: bool = False,
+        promotion_flash_deal: bool = False,
+        hide_out_of_stock: bool = False,
+    ) -> List[Dict]:
+        # each filter narrows down the candidate set, like the live search does.
+        # values within a single filter (eg. multiple brands) are OR'd together
+        postings_to_intersect = list()
+
+        for token in tokenize(search_term):
+            postings_to_intersect.append(self.by_token.get(token, set()))
+
+        if genders:
+            postings_to_intersect.append(
+                set().union(*(self.by_gender.get(g, set()) for g in genders))
+            )
+
+        if brands:
+            postings_to_intersect.append(
+                set().union(*(self.by_org.get(str(b), set()) for b in brands))
+            )
+
+        if category_id:
+            postings_to_intersect.append(self.by_category.get(str(category_id), set()))
+
+        promotions = {
+            "extra_savings": promotion_extra_savings,
+            "free_shipping": promotion_free_shipping,
+            "friends_and_family": promotion_friends_and_family,
+            "outlet": promotion_outlet,
+            "flash_deal": promotion_flash_deal,
+        }
+        requested_promotions = [name for name, enabled in promotions.items() if enabled]
+        if requested_promotions:
+            postings_to_intersect.append(
+                set().union(
+                    *(self.by_promotion.get(p, set()) for p in requested_promotions)
+                )
+            )
+
+        if hide_out_of_stock:
+            postings_to_intersect.append(self.in_stock)
+
+        if postings_to_intersect:
+            # intersect smallest-first to keep the working set small
+            postings_to_intersect.sort(key=len)
+            product_codes = set(postings_to_intersect[0])
+            for postings in postings_to_intersect[1:]:
+                product_codes &= postings
+                if not product_codes:
+                    break
+        else:
+            product_codes = set(self.products)
+
+        # sorted, so that results come back in a stable order between runs
+        return [
+            dict(self.products[product_code]) for product_code in sorted(product_codes)
+        ]
+
+    def save(self, path: str) -> None:
+        def dump_postings(postings: Dict[str, Set[str]]) -> Dict[str, List[str]]:
+            return {key: sorted(value) for key, value in postings.items()}
+
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "products": self.products,
+                    "by_org": dump_postings(self.by_org),
+                    "by_category": dump_postings(self.by_category),
+                    "by_gender": dump_postings(self.by_gender),
+                    "by_promotion": dump_postings(self.by_promotion),
+                    "in_stock": sorted(self.in_stock),
+                    "by_token": dump_postings(self.by_token),
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "ProductIndex":
+        with open(path, "r") as f:
+            index_json = json.load(f)
+
+        index = cls()
+        index.products = index_json["products"]
+        for attr in ("by_org", "by_category", "by_gender", "by_promotion", "by_token"):
+            getattr(index, attr).update(
+                {key: set(value) for key, value in index_json[attr].items()}
+            )
+        index.in_stock = set(index_json["in_stock"])
+
+        return index
+
+
+def get_category_ancestors(categories: List[Dict]) -> Dict[int, List[int]]:
+    """
+    Map every category ID in a flattened taxonomy (see `flatten_taxonomy`)
+    to a list of itself and all of its ancestors' IDs
+    """
+    parents = dict()
+    for category in categories:
+        for sub_category in category.get("taxonomy", []):
+            if "id" in category and "id" in sub_category:
+                parents[sub_category["id"]] = category["id"]
+
+    ancestors = dict()
+    for category in categories:
+        if "id" not in category:
+            continue
+
+        category_id = category["id"]
+        ancestors[category_id] = [category_id]
+        while category_id in parents:
+            category_id = parents[category_id]
+            ancestors[category["id"]].append(category_id)
+
+    return ancestors
+
+
+def crawl_filtered_product_codes(
+    ev: ExpertvoiceClient, category: Dict, search_kwargs: Dict
+) -> Set[str]:
+    """
+    Collect the productCodes of every product in `category` returned by
+    `ExpertvoiceClient.search_products` with `search_kwargs`, descending into
+    subcategories when there are too many results to page through
+    """
+    if "id" not in category:
+        return set()
+
+    product_codes = {
+        str(product["productCode"])
+        for product in ev.search_products(category_id=category["id"], **search_kwargs)
+    }
+
+    if len(product_codes) >= ExpertvoiceClient.MAX_RESULTS and category.get("taxonomy"):
+        for sub_category in category["taxonomy"]:
+            product_codes |= crawl_filtered_product_codes(
+                ev, sub_category, search_kwargs
+            )
+
+    return product_codes
+
+
+def crawl_trait_postings(
+    ev: ExpertvoiceClient, category: Dict, category_product_codes: Iterable[str]
+) -> Dict:
+    """
+    Collect the gender, promotion and stock postings of a single category,
+    by running a search per trait against it - the same filters the index
+    emulates. `category_product_codes` are the category's unfiltered products.
+    See `ProductIndex.add_trait_postings`
+    """
+
+    def crawl_trait(**search_kwargs) -> List[str]:
+        return sorted(crawl_filtered_product_codes(ev, category, search_kwargs))
+
+    # the category's unfiltered crawl has already recorded these prices
+    price_history, ev.price_history = ev.price_history, None
+    try:
+        trait_postings = {
+            "genders": {
+                gender: crawl_trait(genders=[gender])
+                for gender in sorted(ExpertvoiceClient.GENDERS)
+            },
+            "promotions": {
+                promotion: crawl_trait(**{f"promotion_{promotion}": True})
+                for promotion in ExpertvoiceClient.PROMOTION_LOOKUP
+            },
+            "in_stock": crawl_trait(hide_out_of_stock=True),
+        }
+    finally:
+        ev.price_history = price_history
+
+    # if every trait matches every product, the filters are almost certainly
+    # being ignored, and local trait queries would return unfiltered results
+    category_product_codes = set(category_product_codes)
+    all_postings = [
+        *trait_postings["genders"].values(),
+        *trait_postings["promotions"].values(),
+        trait_postings["in_stock"],
+    ]
+    if category_product_codes and all(
+        category_product_codes <= set(postings) for postings in all_postings
+    ):
+        logger.warning(
+            f"Every trait filter matched every product in category {category['id']} "
+            "- trait postings for this category are likely unfiltered"
+        )
+
+    return trait_postings